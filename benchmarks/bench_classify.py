@@ -0,0 +1,52 @@
+# Micro-benchmark for STIX pattern classification.  Run with
+#   uv run benchmarks/bench_classify.py [pattern count]
+import os
+import sys
+import random
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from common import conversion
+
+def synthetic_patterns(count: int, seed: int = 1) -> list[str]:
+    rng = random.Random(seed)
+    patterns = []
+    for i in range(count):
+        match i % 8:
+            case 0:
+                patterns.append(f"[file:hashes.'SHA-256' = '{rng.getrandbits(256):064x}']")
+            case 1:
+                patterns.append(f"[file:hashes.'MD5' = '{rng.getrandbits(128):032x}']")
+            case 2:
+                patterns.append(f"[domain-name:value = 'host{i}.example{rng.randrange(1000)}.com']")
+            case 3:
+                patterns.append(f"[ipv4-addr:value = '{rng.randrange(1, 224)}.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(256)}']")
+            case 4:
+                patterns.append(f"[ipv6-addr:value = '2001:db8::{rng.getrandbits(16):x}:{rng.getrandbits(16):x}']")
+            case 5:
+                patterns.append(f"[url:value = 'https://host{i}.example.com/path/{rng.getrandbits(32):x}']")
+            case 6:
+                # Hostile domain: long run of labels that fails on the last character
+                patterns.append(f"[domain-name:value = '{"a-" * rng.randrange(100, 2000)}.{"a." * rng.randrange(100, 500)}-']")
+            case 7:
+                patterns.append(f"[email-addr:value = 'user{i}@example.com']")
+    return patterns
+
+def measure(label: str, patterns: list[str], classify):
+    started = time.perf_counter()
+    supported = sum(1 for pattern in patterns if classify(pattern) is not None)
+    elapsed = time.perf_counter() - started
+    print(f"{label:<28}{len(patterns):>10} patterns {elapsed:>9.3f}s {elapsed / len(patterns) * 1e9:>10.0f} ns/pattern ({supported} supported)")
+
+def main(count: int):
+    patterns = synthetic_patterns(count)
+    measure("parse (uncached)", patterns, conversion.parse)
+    conversion.pattern_cache.entries.clear()
+    measure("classify (cold cache)", patterns, conversion.classify)
+    measure("classify (warm cache)", patterns, conversion.classify)
+    hostile = [pattern for pattern in patterns if pattern.endswith("-']")]
+    measure("parse (hostile domains)", hostile, conversion.parse)
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200_000)
@@ -0,0 +1,64 @@
+# Memory and throughput benchmark for Indicator over a synthetic feed.  Run with
+#   uv run benchmarks/bench_indicator.py [indicator count]
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from common import Indicator
+from whenever import Instant, TimeDelta
+
+class EagerIndicator:
+    # The previous representation, kept for comparison
+    def __init__(self, source_indicator: dict, tlp: str, valid_for: TimeDelta, source: str):
+        self.name = source_indicator["name"]
+        self.pattern = source_indicator["pattern"]
+        self.pattern_type = source_indicator["pattern_type"]
+        self.valid_from = Instant.parse_rfc3339(source_indicator["valid_from"])
+        self.valid_to = self.valid_from + valid_for
+        self.tlp = tlp
+        self.source = source
+
+def synthetic_feed(count: int) -> list[tuple[dict, str, str]]:
+    # Source and TLP strings are rebuilt per object, as they are when parsed from JSON
+    tlps = ["white", "green", "amber"]
+    return [({
+        "name": f"indicator {i}",
+        "pattern": f"[domain-name:value = 'host{i}.example.com']",
+        "pattern_type": "".join(["st", "ix"]),
+        "valid_from": f"2025-01-{1 + i % 28:02d}T{i % 24:02d}:{i % 60:02d}:{i % 60:02d}.{i % 1000:03d}Z"
+    }, "".join(tlps[i % 3]), "".join(["Example ", "Feed"])) for i in range(count)]
+
+def measure(label: str, count: int, build, touch):
+    valid_for = TimeDelta(hours=24 * 30)
+    feed = synthetic_feed(count)
+    started = time.perf_counter()
+    indicators = [build(source_indicator, tlp, valid_for, source) for (source_indicator, tlp, source) in feed]
+    built = time.perf_counter()
+    for indicator in indicators:
+        touch(indicator)
+    touched = time.perf_counter()
+    del indicators, feed
+    # Memory is measured on a second pass, as tracing allocations skews timings.
+    # The feed is built while tracing so the name and pattern strings that
+    # indicators keep from it are counted, then freed so only what the
+    # indicators retain is left
+    tracemalloc.start()
+    feed = synthetic_feed(count)
+    indicators = [build(source_indicator, tlp, valid_for, source) for (source_indicator, tlp, source) in feed]
+    del feed
+    (retained, _) = tracemalloc.get_traced_memory()
+    for indicator in indicators:
+        touch(indicator)
+    (after_touch, _) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<18}{len(indicators):>9} indicators  build {built - started:>6.3f}s  valid_to {touched - built:>6.3f}s  {retained / len(indicators):>5.0f} bytes/indicator ({after_touch / len(indicators):.0f} after valid_to)")
+
+def main(count: int):
+    measure("eager, __dict__", count, EagerIndicator, lambda indicator: indicator.valid_to)
+    measure("__slots__", count, Indicator, lambda indicator: indicator.valid_to)
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
@@ -0,0 +1,107 @@
+# End-to-end benchmark of a sync cycle, run entirely offline against a local
+# TAXII 2.1 feed (fake_taxii.py) and a mock Falcon API (fake_falcon.py).  Run with
+#   uv run benchmarks/bench_sync.py [--latency seconds] [--rate-limit requests per minute] [indicator count ...]
+# Each count is synced by copy_to into a CrowdStrike and an EDL destination
+# from empty state, in its own process so peak RSS is measured per run
+import argparse
+import logging
+import multiprocessing
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+def serve_fakes(sizes: list[int], latency: float, rate_limit: int, ports: multiprocessing.Queue):
+    import fake_falcon
+    import fake_taxii
+    taxii = fake_taxii.serve(fake_taxii.FakeTAXIIFeed(sizes))
+    falcon = fake_falcon.serve(fake_falcon.FakeFalcon(latency, rate_limit))
+    ports.put((taxii.server_address[1], falcon.server_address[1]))
+    threading.Event().wait()
+
+def peak_rss_mib() -> float | None:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def sync(count: int, taxii_port: int, falcon_port: int, page_size: int, chunk_size: int, workers: int, results: multiprocessing.Queue):
+    from common import metrics
+    from transit import CrowdStrikeIndicatorDestination, TAXII21IndicatorSource, EDLDestination, copy_to
+    from whenever import TimeDelta
+    logging.basicConfig(level=logging.ERROR, format="%(levelname)s %(name)s: %(message)s")
+
+    with tempfile.TemporaryDirectory() as state_dir, tempfile.TemporaryDirectory() as output_dir:
+        log = logging.getLogger("bench")
+        source = TAXII21IndicatorSource(log, f"http://127.0.0.1:{taxii_port}/taxii2/", "bench", "bench", page_size, 2)
+        destinations = [
+            CrowdStrikeIndicatorDestination(log, state_dir, "bench_crowdstrike", "bench", "bench", f"http://127.0.0.1:{falcon_port}", "detect", "low", workers, TimeDelta(hours=24)),
+            EDLDestination(log, state_dir, "bench_edl", output_dir, "domains.txt", "ips.txt", "urls.txt", False, False)
+        ]
+        started = time.perf_counter()
+        copy_to(log, source, destinations, f"bench-{count}", TimeDelta(hours=24 * 30), state_dir, chunk_size)
+        elapsed = time.perf_counter() - started
+
+    api_calls = {}
+    for (labels, calls) in metrics.counters.get("iocshuttle_api_calls_total", {}).items():
+        labels = dict(labels)
+        key = "throttled" if labels["status"] == "429" else labels["operation"].removeprefix("indicator_")
+        api_calls[key] = api_calls.get(key, 0) + int(calls)
+    stages = {}
+    for (labels, seconds) in metrics.counters.get("iocshuttle_stage_seconds_total", {}).items():
+        stage = dict(labels)["stage"]
+        stages[stage] = stages.get(stage, 0) + seconds
+    results.put({"count": count, "elapsed": elapsed, "peak_rss": peak_rss_mib(), "api_calls": api_calls, "stages": stages})
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark copy_to against a local TAXII feed and mock Falcon API")
+    parser.add_argument("counts", nargs="*", type=int, default=[10_000, 100_000, 1_000_000], help="indicator counts to sync")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds added to every mock Falcon request")
+    parser.add_argument("--rate-limit", type=int, default=6000, help="mock Falcon requests allowed per minute")
+    parser.add_argument("--page-size", type=int, default=1000, help="TAXII objects requested per page")
+    parser.add_argument("--chunk-size", type=int, default=5000, help="indicators handed to destinations at a time")
+    parser.add_argument("--workers", type=int, default=4, help="concurrent Falcon requests")
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    ports = context.Queue()
+    fakes = context.Process(target=serve_fakes, args=(args.counts, args.latency, args.rate_limit, ports), daemon=True)
+    fakes.start()
+    (taxii_port, falcon_port) = ports.get()
+
+    print(f"{'indicators':>12} {'wall s':>9} {'per s':>9} {'peak MiB':>9}  API calls / stage seconds")
+    try:
+        for count in args.counts:
+            results = context.Queue()
+            run = context.Process(target=sync, args=(count, taxii_port, falcon_port, args.page_size, args.chunk_size, args.workers, results))
+            run.start()
+            result = None
+            while result is None:
+                try:
+                    result = results.get(timeout=1)
+                except queue.Empty:
+                    if not run.is_alive():
+                        print(f"Sync of {count} indicators failed (exit code {run.exitcode})")
+                        return 1
+            run.join()
+            peak_rss = f"{result['peak_rss']:9.1f}" if result["peak_rss"] is not None else f"{'n/a':>9}"
+            api_calls = " ".join(f"{operation}={calls}" for (operation, calls) in sorted(result["api_calls"].items()))
+            stages = " ".join(f"{stage}={seconds:.2f}" for (stage, seconds) in sorted(result["stages"].items()))
+            print(f"{count:>12,} {result['elapsed']:9.2f} {count / result['elapsed']:9.0f} {peak_rss}  {api_calls}")
+            print(f"{'':>43}  {stages}")
+    finally:
+        fakes.terminate()
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
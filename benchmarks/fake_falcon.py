@@ -0,0 +1,122 @@
+# A local stand-in for the Falcon OAuth2 and IOC APIs, used by bench_sync.py.
+# Every request is delayed by a fixed latency, and requests beyond
+# rate_limit in any minute are refused with 429 and the X-RateLimit-*
+# headers the real API sends
+import itertools
+import json
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ioc_path = "/iocs/entities/indicators/v1"
+
+class FakeFalcon:
+    def __init__(self, latency: float, rate_limit: int):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.indicators: dict[str, dict] = {}
+        self.ids = itertools.count()
+        self.window = 0
+        self.window_requests = 0
+        self.lock = threading.Lock()
+
+    def admit(self) -> tuple[bool, dict[str, str]]:
+        with self.lock:
+            window = int(time.time() // 60)
+            if window != self.window:
+                (self.window, self.window_requests) = (window, 0)
+            self.window_requests += 1
+            remaining = self.rate_limit - self.window_requests
+            headers = {"X-RateLimit-Limit": str(self.rate_limit), "X-RateLimit-Remaining": str(max(0, remaining))}
+            if remaining < 0:
+                headers["X-RateLimit-RetryAfter"] = str((window + 1) * 60)
+            return (remaining >= 0, headers)
+
+    def combined(self, query: dict[str, list[str]]) -> dict:
+        source = query["filter"][0].partition("'")[2].rstrip("'")
+        offset = int(query["after"][0]) if query.get("after") else 0
+        limit = int(query["limit"][0])
+        with self.lock:
+            matching = [indicator for indicator in self.indicators.values() if indicator["source"] == source]
+        page = matching[offset:offset + limit]
+        after = str(offset + limit) if offset + limit < len(matching) else ""
+        return {"meta": {"pagination": {"after": after, "limit": limit, "total": len(matching)}}, "resources": page, "errors": []}
+
+    def create(self, body: dict) -> dict:
+        created = []
+        with self.lock:
+            for indicator in body["indicators"]:
+                indicator = dict(indicator, id=str(next(self.ids)))
+                self.indicators[indicator["id"]] = indicator
+                created.append(indicator)
+        return {"meta": {}, "resources": created, "errors": []}
+
+    def update(self, body: dict) -> dict:
+        with self.lock:
+            for indicator in body["indicators"]:
+                self.indicators.setdefault(indicator["id"], {}).update(indicator)
+        return {"meta": {}, "resources": body["indicators"], "errors": []}
+
+    def delete(self, query: dict[str, list[str]]) -> dict:
+        ids = [id for value in query.get("ids", []) for id in value.split(",")]
+        with self.lock:
+            for id in ids:
+                self.indicators.pop(id, None)
+        return {"meta": {}, "resources": ids, "errors": []}
+
+def serve(falcon: FakeFalcon, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    class FalconHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            self.handle_request("GET")
+
+        def do_POST(self):
+            self.handle_request("POST")
+
+        def do_PATCH(self):
+            self.handle_request("PATCH")
+
+        def do_DELETE(self):
+            self.handle_request("DELETE")
+
+        def handle_request(self, method: str):
+            url = urllib.parse.urlsplit(self.path)
+            query = urllib.parse.parse_qs(url.query)
+            length = int(self.headers.get("Content-Length") or 0)
+            payload = self.rfile.read(length) if length else b""
+            time.sleep(falcon.latency)
+            if url.path == "/oauth2/token" and method == "POST":
+                return self.reply(201, {"access_token": "benchmark", "token_type": "bearer", "expires_in": 1799}, {})
+            (admitted, headers) = falcon.admit()
+            if not admitted:
+                return self.reply(429, {"meta": {}, "resources": None, "errors": [{"code": 429, "message": "API rate limit exceeded."}]}, headers)
+            match (method, url.path):
+                case ("GET", "/iocs/combined/indicator/v1"):
+                    self.reply(200, falcon.combined(query), headers)
+                case ("POST", path) if path == ioc_path:
+                    self.reply(201, falcon.create(json.loads(payload)), headers)
+                case ("PATCH", path) if path == ioc_path:
+                    self.reply(200, falcon.update(json.loads(payload)), headers)
+                case ("DELETE", path) if path == ioc_path:
+                    self.reply(200, falcon.delete(query), headers)
+                case _:
+                    self.reply(404, {"meta": {}, "resources": None, "errors": [{"code": 404, "message": "Not found"}]}, headers)
+
+        def reply(self, status: int, document: dict, headers: dict[str, str]):
+            body = json.dumps(document).encode("utf8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for (name, value) in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), FalconHandler)
+    threading.Thread(target=server.serve_forever, name="fake-falcon", daemon=True).start()
+    return server
@@ -0,0 +1,131 @@
+# A local stand-in for a TAXII 2.1 feed, used by bench_sync.py.  Serves one
+# collection per requested size, named bench-<count>, holding that many
+# synthetic indicators with the identities and TLP marking definitions they
+# reference.  Every tenth indicator repeats one seen 1000 indicators earlier
+import hashlib
+import json
+import threading
+import urllib.parse
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from whenever import Instant, TimeDelta
+
+taxii_media_type = "application/taxii+json;version=2.1"
+
+marking_definitions = {
+    tlp: {
+        "type": "marking-definition",
+        "spec_version": "2.1",
+        "id": f"marking-definition--{uuid.uuid5(uuid.NAMESPACE_URL, tlp)}",
+        "created": "2017-01-20T00:00:00.000Z",
+        "definition_type": "tlp",
+        "name": f"TLP:{tlp.upper()}",
+        "definition": {"tlp": tlp}
+    } for tlp in ["white", "green", "amber"]
+}
+
+def identity(count: int) -> dict:
+    return {
+        "type": "identity",
+        "spec_version": "2.1",
+        "id": f"identity--{uuid.uuid5(uuid.NAMESPACE_URL, str(count))}",
+        "created": "2020-01-01T00:00:00.000Z",
+        "modified": "2020-01-01T00:00:00.000Z",
+        "name": f"Benchmark Feed {count}",
+        "identity_class": "organization"
+    }
+
+def pattern(i: int) -> str:
+    match i % 5:
+        case 0:
+            return f"[domain-name:value = 'host{i}.bench.example']"
+        case 1:
+            return f"[ipv4-addr:value = '10.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}']"
+        case 2:
+            return f"[url:value = 'http://host{i}.bench.example/path/{i}']"
+        case 3:
+            return f"[file:hashes.'SHA-256' = '{hashlib.sha256(str(i).encode("utf8")).hexdigest()}']"
+        case _:
+            return f"[file:hashes.'MD5' = '{hashlib.md5(str(i).encode("utf8")).hexdigest()}']"
+
+class FakeTAXIIFeed:
+    # Indicator i of every collection was added at base + i milliseconds, so
+    # added_after maps directly onto an offset into the collection
+    step = TimeDelta(milliseconds=1)
+
+    def __init__(self, sizes: list[int]):
+        self.sizes = sizes
+        self.base = Instant.now().round("millisecond") - TimeDelta(hours=24)
+
+    def added(self, i: int) -> Instant:
+        return self.base + self.step * i
+
+    def first_after(self, added_after: str | None) -> int:
+        if added_after is None:
+            return 0
+        since = Instant.parse_rfc3339(added_after)
+        return max(0, int((since - self.base) / self.step) + 1)
+
+    def indicator(self, count: int, i: int) -> dict:
+        added = self.added(i).format_rfc3339().replace(" ", "T")
+        return {
+            "type": "indicator",
+            "spec_version": "2.1",
+            "id": f"indicator--{uuid.UUID(int=i)}",
+            "created": added,
+            "modified": added,
+            "name": f"Benchmark indicator {i}",
+            "pattern": pattern(i - 1000 if i % 10 == 9 and i >= 1000 else i),
+            "pattern_type": "stix",
+            "valid_from": added,
+            "created_by_ref": identity(count)["id"],
+            "object_marking_refs": [marking_definitions[["white", "green", "amber"][i % 3]]["id"]]
+        }
+
+    def envelope(self, count: int, limit: int, offset: int) -> dict:
+        end = min(count, offset + limit)
+        envelope = {"more": end < count}
+        if end < count:
+            envelope["next"] = str(end)
+        if offset < end:
+            envelope["objects"] = [identity(count)] + list(marking_definitions.values()) + [self.indicator(count, i) for i in range(offset, end)]
+            envelope["x_cyber_gc_ca_date_added_last"] = self.added(end - 1).format_rfc3339().replace(" ", "T")
+        return envelope
+
+def serve(feed: FakeTAXIIFeed, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    class TAXIIHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            query = dict(urllib.parse.parse_qsl(url.query))
+            root = f"http://{host}:{server.server_address[1]}"
+            parts = [part for part in url.path.split("/") if part]
+            match parts:
+                case ["taxii2"]:
+                    self.reply({"title": "Benchmark TAXII", "api_roots": [f"{root}/api1/"]})
+                case ["api1"]:
+                    self.reply({"title": "Benchmark API root", "versions": [taxii_media_type], "max_content_length": 104857600})
+                case ["api1", "collections"]:
+                    self.reply({"collections": [{"id": f"bench-{count}", "title": f"bench-{count}", "can_read": True, "can_write": False, "media_types": ["application/stix+json;version=2.1"]} for count in feed.sizes]})
+                case ["api1", "collections", collection_id, "objects"] if collection_id.startswith("bench-"):
+                    offset = int(query["next"]) if "next" in query else feed.first_after(query.get("added_after"))
+                    self.reply(feed.envelope(int(collection_id.removeprefix("bench-")), int(query.get("limit") or 1000), offset))
+                case ["api1", "collections", collection_id] if collection_id.startswith("bench-"):
+                    self.reply({"id": collection_id, "title": collection_id, "can_read": True, "can_write": False})
+                case _:
+                    self.send_error(404)
+
+        def reply(self, document: dict):
+            body = json.dumps(document).encode("utf8")
+            self.send_response(200)
+            self.send_header("Content-Type", taxii_media_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), TAXIIHandler)
+    threading.Thread(target=server.serve_forever, name="fake-taxii", daemon=True).start()
+    return server
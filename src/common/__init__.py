@@ -1,20 +1,38 @@
 from whenever import Instant, TimeDelta
 from collections.abc import Iterator
 from abc import ABC, abstractmethod
+from .statestore import StateStore
+from .conversion import classify
+from .metrics import metrics
+import threading
 import typing
+import sys
 
 class STIXConversionException(Exception):
     pass
 
 class Indicator:
+    # Feeds can hold millions of these, so they carry no instance dict, share
+    # the few distinct tlp/source/pattern_type strings, and keep valid_from as
+    # integer nanoseconds rather than an Instant or the source string
+    __slots__ = ("name", "pattern", "pattern_type", "valid_from_nanos", "valid_for", "tlp", "source")
+
     def __init__(self, source_indicator: dict, tlp: str, valid_for: TimeDelta, source: str):
         self.name = source_indicator["name"]
         self.pattern = source_indicator["pattern"]
-        self.pattern_type = source_indicator["pattern_type"]
-        self.valid_from = Instant.parse_rfc3339(source_indicator["valid_from"])
-        self.valid_to = self.valid_from + valid_for
-        self.tlp = tlp
-        self.source = source
+        self.pattern_type = sys.intern(source_indicator["pattern_type"])
+        self.valid_from_nanos = Instant.parse_rfc3339(source_indicator["valid_from"]).timestamp_nanos()
+        self.valid_for = valid_for
+        self.tlp = sys.intern(tlp)
+        self.source = sys.intern(source)
+
+    @property
+    def valid_from(self) -> Instant:
+        return Instant.from_timestamp_nanos(self.valid_from_nanos)
+
+    @property
+    def valid_to(self) -> Instant:
+        return self.valid_from + self.valid_for
     
     def __str__(self):
         return f"{self.name} (tlp:{self.tlp})"
@@ -34,6 +52,25 @@ class IndicatorSource(ABC):
         pass
 
 class IndicatorDestination(ABC):
+    # consume may be called several times per cycle with successive chunks of
+    # the feed, followed by a single flush once the source is exhausted.  A
+    # destination may be shared by connections running in parallel, so callers
+    # hold its lock around each call
+    def __init__(self, name: str):
+        self.name = name
+        self.lock = threading.RLock()
+
     @abstractmethod
     def consume(self, indicators: list[Indicator]):
+        pass
+
+    def flush(self):
+        pass
+
+    # Destinations that hold indicators until they expire report when the
+    # earliest one does, and remove everything expired when expire is called
+    def next_expiration(self) -> typing.Optional[Instant]:
+        return None
+
+    def expire(self):
         pass
\ No newline at end of file
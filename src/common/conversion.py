@@ -0,0 +1,100 @@
+from netaddr import IPAddress
+from collections.abc import Callable
+import threading
+import typing
+import re
+
+# Every expression used here is free of nested quantifiers, so classifying a
+# pattern is linear in its length however hostile the input
+stix_comparison = re.compile(r"\[(?P<object>[a-z0-9-]+):(?P<path>[a-z0-9_.]+)\s*=\s*'(?P<value>[^'\\]*(?:\\.[^'\\]*)*)'\]")
+stix_hash = re.compile(r"file:hashes\.'(?P<type>[\w-]+)'\s*=\s*'(?P<value>[a-zA-Z\d]+)'")
+domain_label = re.compile(r"(?:xn--|_)?[a-z0-9][a-z0-9-]{0,61}")
+domain_tld = re.compile(r"(?:xn--)?[a-z0-9][a-z0-9-]{0,60}")
+
+stix_hash_types = {"SHA-256": "sha256", "MD5": "md5"}
+
+unsupported = ("", "")
+
+class ConversionCache:
+    # Patterns repeat across destinations, connections and cycles, so each
+    # distinct pattern string is only classified once per process.  Patterns
+    # that can't be classified are cached too
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries: dict[str, tuple[str, str]] = {}
+        self.lock = threading.Lock()
+
+    def get(self, pattern: str) -> typing.Optional[tuple[str, str]]:
+        return self.entries.get(pattern)
+
+    def put(self, pattern: str, converted: tuple[str, str]):
+        with self.lock:
+            if len(self.entries) >= self.max_entries:
+                self.entries.clear()
+            self.entries[pattern] = converted
+
+pattern_cache = ConversionCache(1_000_000)
+
+def classify(pattern: str) -> typing.Optional[tuple[str, str]]:
+    # Returns the indicator type (md5, sha256, domain, ipv4, ipv6 or url) and
+    # normalised value for a STIX pattern, or None if it isn't supported
+    converted = pattern_cache.get(pattern)
+    if converted is None:
+        converted = parse(pattern) or unsupported
+        pattern_cache.put(pattern, converted)
+    return converted if converted is not unsupported else None
+
+def parse(pattern: str) -> typing.Optional[tuple[str, str]]:
+    # Dispatch on the object type prefix so each pattern meets exactly one parser
+    if not pattern.startswith("["):
+        return None
+    parser = parsers.get(pattern[1:pattern.find(":")])
+    return parser(pattern) if parser is not None else None
+
+def parse_file(pattern: str) -> typing.Optional[tuple[str, str]]:
+    for expression_fragment in stix_hash.finditer(pattern):
+        if expression_fragment["type"] in stix_hash_types:
+            return (stix_hash_types[expression_fragment["type"]], expression_fragment["value"].lower())
+    return None
+
+def comparison_value(pattern: str) -> typing.Optional[str]:
+    comparison = stix_comparison.fullmatch(pattern)
+    return comparison["value"] if comparison is not None and comparison["path"] == "value" else None
+
+def parse_domain(pattern: str) -> typing.Optional[tuple[str, str]]:
+    value = comparison_value(pattern)
+    if value is None or len(value) > 253:
+        return None
+    labels = value.lower().split(".")
+    if not all(domain_label.fullmatch(label) and not label.endswith("-") for label in labels[:-1]) or not domain_tld.fullmatch(labels[-1]):
+        return None
+    return ("domain", ".".join(labels))
+
+def parse_ip(pattern: str, version: int) -> typing.Optional[tuple[str, str]]:
+    value = comparison_value(pattern)
+    if value is None:
+        return None
+    try:
+        address = IPAddress(value)
+    except Exception:
+        return None
+    # An ipv4-addr object holding an IPv6 address, or the reverse, is malformed
+    return (f"ipv{version}", str(address)) if address.version == version else None
+
+def parse_ipv4(pattern: str) -> typing.Optional[tuple[str, str]]:
+    return parse_ip(pattern, 4)
+
+def parse_ipv6(pattern: str) -> typing.Optional[tuple[str, str]]:
+    return parse_ip(pattern, 6)
+
+def parse_url(pattern: str) -> typing.Optional[tuple[str, str]]:
+    value = comparison_value(pattern)
+    return ("url", value.lower()) if value else None
+
+parsers: dict[str, Callable[[str], typing.Optional[tuple[str, str]]]] = {
+    "file": parse_file,
+    "domain-name": parse_domain,
+    "ipv4-addr": parse_ipv4,
+    "ipv6-addr": parse_ipv6,
+    "url": parse_url
+}
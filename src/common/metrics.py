@@ -0,0 +1,96 @@
+from collections.abc import Iterator
+from contextlib import contextmanager
+import contextvars
+import threading
+import tempfile
+import time
+import os
+
+# Labels that apply to everything recorded below a point in the call stack,
+# such as the connection a cycle belongs to
+context_labels: contextvars.ContextVar[tuple[tuple[str, str], ...]] = contextvars.ContextVar("context_labels", default=())
+
+class Metrics:
+    # Process-wide counters and stage timings, rendered in the Prometheus
+    # text exposition format
+    def __init__(self):
+        self.counters: dict[str, dict[tuple[tuple[str, str], ...], float]] = {}
+        self.gauges: dict[str, dict[tuple[tuple[str, str], ...], float]] = {}
+        self.lock = threading.Lock()
+
+    def labels(self, labels: dict[str, str]) -> tuple[tuple[str, str], ...]:
+        return tuple(sorted(dict(context_labels.get(), **labels).items()))
+
+    def count(self, name: str, amount: float = 1, **labels: str):
+        key = self.labels(labels)
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def gauge(self, name: str, value: float, **labels: str):
+        key = self.labels(labels)
+        with self.lock:
+            self.gauges.setdefault(name, {})[key] = value
+
+    def observe(self, stage: str, seconds: float, **labels: str):
+        self.count("iocshuttle_stage_seconds_total", seconds, stage=stage, **labels)
+        self.count("iocshuttle_stage_runs_total", 1, stage=stage, **labels)
+
+    @contextmanager
+    def timed(self, stage: str, **labels: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started, **labels)
+
+    @contextmanager
+    def context(self, **labels: str) -> Iterator[None]:
+        token = context_labels.set(self.labels(labels))
+        try:
+            yield
+        finally:
+            context_labels.reset(token)
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            for (kind, metrics) in [("counter", self.counters), ("gauge", self.gauges)]:
+                for (name, series) in sorted(metrics.items()):
+                    lines.append(f"# TYPE {name} {kind}")
+                    for (labels, value) in sorted(series.items()):
+                        rendered_labels = ",".join(f"{label}=\"{escape(value)}\"" for (label, value) in labels)
+                        lines.append(f"{name}{{{rendered_labels}}} {value}" if rendered_labels else f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        with tempfile.NamedTemporaryFile(mode="w", encoding="utf8", dir=os.path.dirname(os.path.abspath(path)), prefix=f".{os.path.basename(path)}.", delete=False) as tmp:
+            tmp.write(self.render())
+        os.chmod(tmp.name, 0o644)
+        os.replace(tmp.name, path)
+
+    def serve(self, host: str, port: int):
+        # Imported here as most runs never serve metrics
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode("utf8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        return server
+
+def escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+metrics = Metrics()
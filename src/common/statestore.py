@@ -0,0 +1,214 @@
+from whenever import Instant
+from collections.abc import Callable, Iterable, Iterator
+import threading
+import typing
+import shelve
+import sqlite3
+import dbm
+import os
+
+schema = """
+CREATE TABLE IF NOT EXISTS expiring (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    valid_to INTEGER,
+    data TEXT,
+    PRIMARY KEY (namespace, key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS expiring_valid_to ON expiring (namespace, valid_to);
+CREATE TABLE IF NOT EXISTS bookmarks (
+    feed TEXT PRIMARY KEY,
+    last_added INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS ip_addresses (
+    namespace TEXT NOT NULL,
+    family INTEGER NOT NULL,
+    address BLOB NOT NULL,
+    valid_to INTEGER NOT NULL,
+    PRIMARY KEY (namespace, family, address)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS ip_addresses_valid_to ON ip_addresses (namespace, valid_to);
+CREATE TABLE IF NOT EXISTS ip_ranges (
+    namespace TEXT NOT NULL,
+    family INTEGER NOT NULL,
+    first BLOB NOT NULL,
+    last BLOB NOT NULL,
+    PRIMARY KEY (namespace, family, first)
+) WITHOUT ROWID;
+"""
+
+legacy_shelf_suffixes = ["", ".db", ".dat", ".dir", ".bak"]
+
+address_widths = {4: 4, 6: 16}
+
+# Serialises schema setup and shelve migration between connections opened
+# concurrently by different threads
+setup_lock = threading.Lock()
+
+def to_nanos(instant: typing.Optional[Instant]) -> typing.Optional[int]:
+    return instant.timestamp_nanos() if instant is not None else None
+
+def from_nanos(nanos: typing.Optional[int]) -> typing.Optional[Instant]:
+    return Instant.from_timestamp_nanos(nanos) if nanos is not None else None
+
+def to_blob(family: int, address: int) -> bytes:
+    # Fixed width big-endian, so SQLite's memcmp ordering is numeric ordering
+    return address.to_bytes(address_widths[family], "big")
+
+def from_blob(blob: bytes) -> int:
+    return int.from_bytes(blob, "big")
+
+class StateStore:
+    # All timestamps are stored as integer nanoseconds since the epoch so
+    # expiry is a range query on the (namespace, valid_to) index
+    def __init__(self, state_dir: str):
+        self.state_dir = state_dir
+        self.path = os.path.join(state_dir, "state.sqlite3")
+
+    def __enter__(self):
+        self.db = sqlite3.connect(self.path, timeout=60)
+        with setup_lock:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            with self.db:
+                self.db.executescript(schema)
+        return self
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        self.db.close()
+
+    def upsert(self, namespace: str, rows: Iterable[tuple[str, typing.Optional[Instant], typing.Optional[str]]]) -> int:
+        # Returns the number of keys added, rather than merely extended
+        rows = [(namespace, key, to_nanos(valid_to), data) for (key, valid_to, data) in rows]
+        with self.db:
+            inserted = self.db.executemany("INSERT OR IGNORE INTO expiring (namespace, key, valid_to, data) VALUES (?, ?, ?, ?)", rows).rowcount
+            if inserted != len(rows):
+                self.db.executemany("UPDATE expiring SET valid_to = ?3, data = ?4 WHERE namespace = ?1 AND key = ?2 AND (valid_to IS NULL OR valid_to < ?3)", rows)
+            self.bump_version(namespace, inserted)
+            return inserted
+
+    def version(self, namespace: str) -> int:
+        # Incremented whenever keys are added to or removed from the namespace
+        version = self.meta(f"{namespace}_version")
+        return int(version) if version is not None else 0
+
+    def bump_version(self, namespace: str, changes: int):
+        if changes > 0:
+            self.db.execute("INSERT INTO meta (key, value) VALUES (?, '1') ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1", (f"{namespace}_version",))
+
+    def get(self, namespace: str, key: str) -> typing.Optional[tuple[typing.Optional[Instant], typing.Optional[str]]]:
+        row = self.db.execute("SELECT valid_to, data FROM expiring WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()
+        return (from_nanos(row[0]), row[1]) if row is not None else None
+
+    def keys(self, namespace: str) -> Iterator[str]:
+        return (key for (key,) in self.db.execute("SELECT key FROM expiring WHERE namespace = ? ORDER BY key", (namespace,)))
+
+    def expired(self, namespace: str, now: Instant) -> list[tuple[str, Instant, typing.Optional[str]]]:
+        return [(key, from_nanos(valid_to), data) for (key, valid_to, data) in self.db.execute("SELECT key, valid_to, data FROM expiring WHERE namespace = ? AND valid_to < ?", (namespace, to_nanos(now)))]
+
+    def next_expiry(self, namespace: str) -> typing.Optional[Instant]:
+        # The earliest valid_to in the namespace, read from the valid_to index
+        return from_nanos(self.db.execute("SELECT MIN(valid_to) FROM expiring WHERE namespace = ?", (namespace,)).fetchone()[0])
+
+    def expire(self, namespace: str, now: Instant) -> int:
+        with self.db:
+            expired = self.db.execute("DELETE FROM expiring WHERE namespace = ? AND valid_to < ?", (namespace, to_nanos(now))).rowcount
+            self.bump_version(namespace, expired)
+            return expired
+
+    def remove(self, namespace: str, keys: Iterable[str]):
+        with self.db:
+            removed = self.db.executemany("DELETE FROM expiring WHERE namespace = ? AND key = ?", ((namespace, key) for key in keys)).rowcount
+            self.bump_version(namespace, removed)
+
+    def replace(self, namespace: str, rows: Iterable[tuple[str, typing.Optional[Instant], typing.Optional[str]]]):
+        with self.db:
+            self.db.execute("DELETE FROM expiring WHERE namespace = ?", (namespace,))
+            self.db.executemany("INSERT OR REPLACE INTO expiring (namespace, key, valid_to, data) VALUES (?, ?, ?, ?)", ((namespace, key, to_nanos(valid_to), data) for (key, valid_to, data) in rows))
+            self.bump_version(namespace, 1)
+
+    def bookmark(self, feed: str) -> typing.Optional[Instant]:
+        row = self.db.execute("SELECT last_added FROM bookmarks WHERE feed = ?", (feed,)).fetchone()
+        return from_nanos(row[0]) if row is not None else None
+
+    def set_bookmark(self, feed: str, last_added: Instant):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO bookmarks (feed, last_added) VALUES (?, ?)", (feed, to_nanos(last_added)))
+
+    def meta(self, key: str) -> typing.Optional[str]:
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_meta(self, key: str, value: str):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def add_addresses(self, namespace: str, rows: Iterable[tuple[int, int, Instant]]) -> int:
+        # Adds (family, address, valid_to) rows, merging each new address into
+        # the contiguous ranges either side of it.  Expiry is tracked per
+        # address, so the ranges only record which addresses are present
+        added = 0
+        with self.db:
+            for (family, address, valid_to) in rows:
+                blob = to_blob(family, address)
+                if self.db.execute("INSERT OR IGNORE INTO ip_addresses (namespace, family, address, valid_to) VALUES (?, ?, ?, ?)", (namespace, family, blob, to_nanos(valid_to))).rowcount == 0:
+                    self.db.execute("UPDATE ip_addresses SET valid_to = ?4 WHERE namespace = ?1 AND family = ?2 AND address = ?3 AND valid_to < ?4", (namespace, family, blob, to_nanos(valid_to)))
+                    continue
+                added += 1
+                first = last = blob
+                if address > 0:
+                    left = self.db.execute("SELECT first FROM ip_ranges WHERE namespace = ? AND family = ? AND last = ?", (namespace, family, to_blob(family, address - 1))).fetchone()
+                    if left is not None:
+                        self.db.execute("DELETE FROM ip_ranges WHERE namespace = ? AND family = ? AND first = ?", (namespace, family, left[0]))
+                        first = left[0]
+                if address + 1 < 1 << (address_widths[family] * 8):
+                    right = self.db.execute("SELECT last FROM ip_ranges WHERE namespace = ? AND family = ? AND first = ?", (namespace, family, to_blob(family, address + 1))).fetchone()
+                    if right is not None:
+                        self.db.execute("DELETE FROM ip_ranges WHERE namespace = ? AND family = ? AND first = ?", (namespace, family, to_blob(family, address + 1)))
+                        last = right[0]
+                self.db.execute("INSERT INTO ip_ranges (namespace, family, first, last) VALUES (?, ?, ?, ?)", (namespace, family, first, last))
+            self.bump_version(namespace, added)
+        return added
+
+    def expire_addresses(self, namespace: str, now: Instant) -> int:
+        # Removes expired addresses, splitting the ranges that contained them.
+        # The ranges are split from exactly the rows deleted, in the same
+        # transaction, so an address extended concurrently is left whole
+        with self.db:
+            expired = sorted(self.db.execute("DELETE FROM ip_addresses WHERE namespace = ? AND valid_to < ? RETURNING family, address", (namespace, to_nanos(now))).fetchall())
+            splits = {}
+            for (family, blob) in expired:
+                (first, last) = self.db.execute("SELECT first, last FROM ip_ranges WHERE namespace = ? AND family = ? AND first <= ? ORDER BY first DESC LIMIT 1", (namespace, family, blob)).fetchone()
+                splits.setdefault((family, first, last), []).append(from_blob(blob))
+            for ((family, first, last), addresses) in splits.items():
+                self.db.execute("DELETE FROM ip_ranges WHERE namespace = ? AND family = ? AND first = ?", (namespace, family, first))
+                start = from_blob(first)
+                for address in addresses + [from_blob(last) + 1]:
+                    if start < address:
+                        self.db.execute("INSERT INTO ip_ranges (namespace, family, first, last) VALUES (?, ?, ?, ?)", (namespace, family, to_blob(family, start), to_blob(family, address - 1)))
+                    start = address + 1
+            self.bump_version(namespace, len(expired))
+        return len(expired)
+
+    def next_address_expiry(self, namespace: str) -> typing.Optional[Instant]:
+        return from_nanos(self.db.execute("SELECT MIN(valid_to) FROM ip_addresses WHERE namespace = ?", (namespace,)).fetchone()[0])
+
+    def address_ranges(self, namespace: str) -> Iterator[tuple[int, int, int]]:
+        # Yields (family, first, last) in address order, IPv4 before IPv6
+        return ((family, from_blob(first), from_blob(last)) for (family, first, last) in self.db.execute("SELECT family, first, last FROM ip_ranges WHERE namespace = ? ORDER BY family, first", (namespace,)))
+
+    def migrate_shelf(self, name: str, migrate: Callable[[shelve.Shelf], None]):
+        # Imports a shelve file left by earlier versions, then renames it out
+        # of the way so it is only migrated once
+        with setup_lock:
+            if not dbm.whichdb(name):
+                return
+            with shelve.open(name, "r") as shelf:
+                migrate(shelf)
+            for suffix in legacy_shelf_suffixes:
+                if os.path.exists(name + suffix):
+                    os.replace(name + suffix, name + suffix + ".migrated")
@@ -1,19 +1,37 @@
-import pip_system_certs.wrapt_requests
-from transit import CrowdStrikeIndicatorDestination, TAXII21IndicatorSource, copy_to, EDLDestination
+import time
+started = time.perf_counter()
+from transit import copy_to, ConnectionRunner, ExpiryScheduler
+from common import metrics
 from whenever import TimeDelta
+import transit
+import argparse
 import logging
 import logging.handlers
-import tomllib
+import tempfile
+import hashlib
+import json
+import stat
 import os
-import schedule
-import time
+imported = time.perf_counter()
+
+source_types = {"taxii21"}
+destination_types = {"crowdstrike", "edl"}
 
 def main() -> int:
-    with open("config.toml", "rb") as f:
-        config = tomllib.load(f)
+    parser = argparse.ArgumentParser(prog="ioc", description="Copies IoCs from TAXII feeds into CrowdStrike and EDL lists")
+    parser.add_argument("--once", action="store_true", help="run every connection once and exit rather than on a schedule")
+    args = parser.parse_args()
+
+    # Patches requests to use the system certificate store.  Imported here
+    # rather than at module load as it is slow to import
+    import_started = time.perf_counter()
+    import pip_system_certs.wrapt_requests
+    import_seconds = (imported - started) + (time.perf_counter() - import_started)
+
+    (config, connections) = load("config.toml")
 
     log_handler = logging.handlers.TimedRotatingFileHandler(os.path.join(config["general"]["log_dir"], "transit.log"), when="D", interval=1, backupCount=15)
-    formatter = logging.Formatter("%(asctime)s %(levelname)s [%(process)d]: %(message)s", "%b %d %H:%M:%S")
+    formatter = logging.Formatter("%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s", "%b %d %H:%M:%S")
     log_handler.setFormatter(formatter)
     logger = logging.getLogger()
     logger.addHandler(log_handler)
@@ -22,31 +40,65 @@ def main() -> int:
     state_dir = config["general"]["state_dir"]
     valid_for = TimeDelta(hours=config["intelligence"]["valid_for_days"] * 24)
 
+    # Only the sources and destinations used by a connection are created, so
+    # only their client libraries are imported
     sources = {}
     for source_name, source_config in config["source"].items():
+        if not any(connection["source"] == source_name for connection in connections):
+            continue
         log = logging.getLogger(f"source_{source_name}")
         match source_config["type"]:
             case "taxii21":
-                sources[source_name] = TAXII21IndicatorSource(log, source_config["url"], source_config["username"], source_config["password"])
-            case _:
-                logging.fatal(f"Unknown source type {source_config["type"]}")
-                raise SystemExit
+                sources[source_name] = transit.TAXII21IndicatorSource(log, source_config["url"], source_config["username"], source_config["password"], source_config.get("page_size", 200), source_config.get("prefetch", 2))
     
     destinations = {}
     for destination_name, destination_config in config["destination"].items():
+        if not any(destination_name in connection["destinations"] for connection in connections):
+            continue
         log = logging.getLogger(f"destination_{destination_name}")
         match destination_config["type"]:
             case "crowdstrike":
-                destinations[destination_name] = CrowdStrikeIndicatorDestination(log, destination_config["client_id"], destination_config["client_secret"], destination_config["url"], destination_config["action"], destination_config["severity"])
+                destinations[destination_name] = transit.CrowdStrikeIndicatorDestination(log, state_dir, destination_name, destination_config["client_id"], destination_config["client_secret"], destination_config["url"], destination_config["action"], destination_config["severity"], destination_config.get("workers", 4), TimeDelta(hours=destination_config.get("mirror_refresh_hours", 24)))
             case "edl":
-                destinations[destination_name] = EDLDestination(log, state_dir, destination_config["output_dir"], destination_config["domain"], destination_config["ip"], destination_config["url"])
-            case _:
-                logging.fatal(f"Unknown destination type {destination_config["type"]}")
-                raise SystemExit
-    
-    for connection_name, connection_config in config["connection"].items():
+                destinations[destination_name] = transit.EDLDestination(log, state_dir, destination_name, destination_config["output_dir"], destination_config["domain"], destination_config["ip"], destination_config["url"], destination_config.get("compress", False), destination_config.get("etag", False))
+
+    import_seconds += transit.lazy_import_seconds
+    startup_seconds = time.perf_counter() - started
+    metrics.gauge("iocshuttle_startup_seconds", startup_seconds)
+    metrics.gauge("iocshuttle_startup_import_seconds", import_seconds)
+    logging.getLogger("ioc").info(f"Started in {startup_seconds:.3f}s, {import_seconds:.3f}s of which was spent importing modules")
+
+    metrics_config = config.get("metrics", {})
+    if "port" in metrics_config:
+        metrics.serve(metrics_config.get("host", "127.0.0.1"), metrics_config["port"])
+
+    # A one-shot run doesn't need the expiry scheduler, as each connection
+    # removes expired indicators from its destinations when it finishes
+    expiry = None
+    if not args.once:
+        expiry = ExpiryScheduler(logging.getLogger("expiry"), TimeDelta(minutes=config["intelligence"].get("expiry_granularity_minutes", 1)))
+        for destination in destinations.values():
+            expiry.schedule(destination)
+        expiry.start()
+
+    runner = ConnectionRunner(len(connections), TimeDelta(minutes=config["intelligence"]["frequency_minutes"]), metrics_config.get("path"), metrics_config.get("profile_dir"))
+    jobs = []
+    for connection in connections:
+        connection_name = "+".join(connection["names"])
         log = logging.getLogger(f"connection_{connection_name}")
-        schedule.every(config["intelligence"]["frequency_minutes"]).minutes.do(copy_to, log=log, source=sources[connection_config["source"]], destinations=[destinations[destination_name] for destination_name in connection_config["destinations"]], collection_name=connection_config["collection"], valid_for=valid_for, state_dir=state_dir)
+        if len(connection["names"]) > 1:
+            log.info(f"Merged connections {", ".join(connection["names"])} as they share source {connection["source"]} and collection {connection["collection"]}")
+        jobs.append({"log": log, "connection_name": connection_name, "job": copy_to, "source": sources[connection["source"]], "destinations": [destinations[destination_name] for destination_name in connection["destinations"]], "collection_name": connection["collection"], "valid_for": valid_for, "state_dir": state_dir, "chunk_size": config["intelligence"].get("chunk_size", 5000), "expiry": expiry})
+
+    if args.once:
+        runs = [runner.submit(**job) for job in jobs]
+        succeeded = all(run.result() for run in runs)
+        runner.shutdown()
+        return 0 if succeeded else 1
+
+    import schedule # only needed when running on a schedule
+    for job in jobs:
+        schedule.every(config["intelligence"]["frequency_minutes"]).minutes.do(runner.submit, **job)
     
     schedule.run_all()
     while True:
@@ -54,4 +106,72 @@ def main() -> int:
             schedule.run_pending()
             time.sleep(1)
         except KeyboardInterrupt:
+            runner.shutdown()
+            expiry.stop()
             break
+
+def load(config_path: str) -> tuple[dict, list[dict]]:
+    # The parsed and validated config and the connection plan resolved from it
+    # are cached beside the config, and reused until its contents change
+    with open(config_path, "rb") as f:
+        content = f.read()
+    digest = hashlib.sha256(content).hexdigest()
+    cache_path = f"{config_path}.cache"
+    try:
+        with open(cache_path, "r", encoding="utf8") as f:
+            cached = json.load(f)
+        if cached["digest"] == digest:
+            return (cached["config"], cached["connections"])
+    except (OSError, ValueError, KeyError):
+        pass
+
+    import tomllib # only needed when the cache is stale
+    config = tomllib.loads(content.decode("utf8"))
+    validate(config)
+    connections = plan(config)
+    try:
+        cache = json.dumps({"digest": digest, "config": config, "connections": connections})
+    except TypeError: # values JSON can't hold, such as TOML dates, leave the config uncached
+        return (config, connections)
+    try:
+        # The cache holds the same credentials as the config, so it gets the same permissions
+        with tempfile.NamedTemporaryFile(mode="w", encoding="utf8", dir=os.path.dirname(os.path.abspath(cache_path)), prefix=f".{os.path.basename(cache_path)}.", delete=False) as tmp:
+            try:
+                tmp.write(cache)
+                tmp.close()
+                os.chmod(tmp.name, stat.S_IMODE(os.stat(config_path).st_mode))
+                os.replace(tmp.name, cache_path)
+            except BaseException:
+                os.unlink(tmp.name)
+                raise
+    except OSError:
+        pass
+    return (config, connections)
+
+def validate(config: dict):
+    for source_name, source_config in config["source"].items():
+        if source_config["type"] not in source_types:
+            raise SystemExit(f"Unknown source type {source_config["type"]} for source {source_name}")
+    for destination_name, destination_config in config["destination"].items():
+        if destination_config["type"] not in destination_types:
+            raise SystemExit(f"Unknown destination type {destination_config["type"]} for destination {destination_name}")
+    for connection_name, connection_config in config["connection"].items():
+        if connection_config["source"] not in config["source"]:
+            raise SystemExit(f"Connection {connection_name} uses undefined source {connection_config["source"]}")
+        for destination_name in connection_config["destinations"]:
+            if destination_name not in config["destination"]:
+                raise SystemExit(f"Connection {connection_name} uses undefined destination {destination_name}")
+
+def plan(config: dict) -> list[dict]:
+    # Connections reading the same collection from the same source are merged
+    # so each page is fetched once per cycle and fanned out to every destination
+    connections = {}
+    for connection_name, connection_config in config["connection"].items():
+        key = (connection_config["source"], connection_config["collection"])
+        if key not in connections:
+            connections[key] = {"names": [], "source": connection_config["source"], "collection": connection_config["collection"], "destinations": []}
+        connections[key]["names"].append(connection_name)
+        for destination_name in connection_config["destinations"]:
+            if destination_name not in connections[key]["destinations"]:
+                connections[key]["destinations"].append(destination_name)
+    return list(connections.values())
@@ -1,40 +1,102 @@
-from .crowdstrikedestination import CrowdStrikeIndicatorDestination
-from .taxii21source import TAXII21IndicatorSource
-from .edldestination import EDLDestination
-from common import Indicator, IndicatorSource, IndicatorDestination
-from whenever import TimeDelta
-from collections.abc import Iterator
+from .runner import ConnectionRunner
+from .expiry import ExpiryScheduler
+from common import Indicator, IndicatorSource, IndicatorDestination, StateStore, metrics
+from whenever import Instant, TimeDelta
+from collections.abc import Iterable, Iterator
 from logging import Logger
-import shelve
+import importlib
+import typing
+import time
 import os
 
-def copy_to(log: Logger, source: IndicatorSource, destinations: list[IndicatorDestination], collection_name: str, valid_for: TimeDelta, state_dir: str):
-    with shelve.open(os.path.join(state_dir, "feed_bookmarks"), "c") as shelf:
+# Sources and destinations pull in their client libraries (falconpy and
+# taxii2client), so each is only imported when it is first used
+lazy_exports = {
+    "CrowdStrikeIndicatorDestination": ".crowdstrikedestination",
+    "TAXII21IndicatorSource": ".taxii21source",
+    "EDLDestination": ".edldestination"
+}
+
+# Time spent importing them, reported at startup
+lazy_import_seconds = 0.0
+
+def __getattr__(name: str):
+    global lazy_import_seconds
+    if name not in lazy_exports:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    started = time.perf_counter()
+    globals()[name] = getattr(importlib.import_module(lazy_exports[name], __name__), name)
+    lazy_import_seconds += time.perf_counter() - started
+    return globals()[name]
+
+def copy_to(log: Logger, source: IndicatorSource, destinations: list[IndicatorDestination], collection_name: str, valid_for: TimeDelta, state_dir: str, chunk_size: int, expiry: typing.Optional[ExpiryScheduler] = None):
+    with StateStore(state_dir) as store:
+        store.migrate_shelf(os.path.join(state_dir, "feed_bookmarks"), lambda shelf: migrate_bookmarks(store, shelf))
         feed_source_name = f"{source.name()}_{collection_name}"
-        feed_last_read = shelf[feed_source_name] if feed_source_name in shelf else None
+        feed_last_read = store.bookmark(feed_source_name)
         log.info(f"Starting copy for source/dest pair named {feed_source_name} (last timestamp is {feed_last_read})")
-        indicators = []
+        seen_indicators = {}
+        source_count = 0
+        chunk = []
+        last_added = None
         for batch in source.produce(collection_name, feed_last_read, valid_for):
-            for indicator in batch.indicators:
-                indicators.append(indicator)
+            source_count += len(batch.indicators)
+            with metrics.timed("dedupe"):
+                indicators = list(dedupe(batch.indicators, seen_indicators))
+            metrics.count("iocshuttle_indicators_received_total", len(batch.indicators))
+            metrics.count("iocshuttle_indicators_delivered_total", len(indicators))
+            chunk.extend(indicators)
             if batch.last_added is not None:
-                shelf[feed_source_name] = batch.last_added
-                log.info(f"Updated last added for {feed_source_name} to {batch.last_added}")
-        log.info("Finished source retrieval.  Starting filter")
-        original_length = len(indicators)
-        indicators = list(dedupe(indicators))
-        log.info(f"Filter finished - removed {original_length - len(indicators)} duplicate indicators from {original_length} source indicators.  Starting destination upload")
+                last_added = batch.last_added
+            if len(chunk) >= chunk_size:
+                deliver_chunked(log, destinations, chunk, chunk_size)
+                chunk = []
+                # Every page in the chunk has been delivered, so a restart can resume after the last one
+                bookmark(log, store, feed_source_name, last_added)
+                last_added = None
+        if len(chunk) != 0:
+            deliver_chunked(log, destinations, chunk, chunk_size)
+        bookmark(log, store, feed_source_name, last_added)
+        log.info(f"Finished source retrieval - {len(seen_indicators)} unique indicators from {source_count} source indicators.  Finishing destination upload")
         for destination in destinations:
             try:
-                destination.consume(indicators)
+                with destination.lock, metrics.context(destination=destination.name):
+                    destination.flush()
             except Exception as err:
                 log.exception(err)
                 raise err
+        if expiry is not None:
+            for destination in destinations:
+                expiry.schedule(destination)
+
+def deliver_chunked(log: Logger, destinations: list[IndicatorDestination], indicators: list[Indicator], chunk_size: int):
+    # Pages are only added to a chunk whole, so the chunk can overrun chunk_size
+    # by up to a page; the overrun is sent on its own
+    for start in range(0, len(indicators), chunk_size):
+        deliver(log, destinations, indicators[start:start + chunk_size])
+
+def deliver(log: Logger, destinations: list[IndicatorDestination], indicators: list[Indicator]):
+    log.info(f"Sending {len(indicators)} indicators to destinations")
+    for destination in destinations:
+        try:
+            with destination.lock, metrics.context(destination=destination.name):
+                destination.consume(indicators)
+        except Exception as err:
+            log.exception(err)
+            raise err
+
+def bookmark(log: Logger, store: StateStore, feed_source_name: str, last_added: typing.Optional[Instant]):
+    if last_added is not None:
+        store.set_bookmark(feed_source_name, last_added)
+        log.info(f"Updated last added for {feed_source_name} to {last_added}")
+
+def migrate_bookmarks(store: StateStore, shelf: dict):
+    for (feed, last_added) in shelf.items():
+        store.set_bookmark(feed, last_added)
 
-def dedupe(source_indicators: Iterator[Indicator]) -> Iterator[Indicator]:
-    seen_indicators = set()
-    for indicator in sorted(source_indicators, key=lambda indicator: indicator.valid_from, reverse=True): # descending order
+def dedupe(source_indicators: Iterable[Indicator], seen_indicators: dict[tuple[str, str], int]) -> Iterator[Indicator]:
+    for indicator in sorted(source_indicators, key=lambda indicator: indicator.valid_from_nanos, reverse=True): # descending order
         indicator_key = (indicator.pattern, indicator.pattern_type)
-        if not indicator_key in seen_indicators:
-            seen_indicators.add(indicator_key)
+        if not indicator_key in seen_indicators or seen_indicators[indicator_key] < indicator.valid_from_nanos:
+            seen_indicators[indicator_key] = indicator.valid_from_nanos
             yield indicator
\ No newline at end of file
@@ -1,51 +1,164 @@
-from common import Indicator, STIXConversionException, IndicatorDestination
+from common import Indicator, STIXConversionException, IndicatorDestination, StateStore, classify, metrics
+from .falconrequests import FalconRequestScheduler
 from falconpy import IOC
 from http import HTTPStatus
-from whenever import Instant
+from whenever import Instant, TimeDelta
 from logging import Logger
-import re
+from collections.abc import Iterable, Iterator
+import json
 
-cs_hash_from_stix = re.compile(r"file:hashes\.'(?P<type>[\w-]+)'\s*=\s*'(?P<value>[a-zA-Z\d]+)'")
-cs_fqdn_from_stix = re.compile(r"^\[domain-name:value\s*=\s*'(?P<fqdn>(?:(?:(?!-))(?:xn--|_)?[a-z0-9-]{0,61}[a-z0-9]{1,1}\.)*(?:xn--)?(?:[a-z0-9][a-z0-9\-]{0,60}|[a-z0-9-]{1,30}\.[a-z]{2,}))'\]$")
-cs_ipv4_from_stix = re.compile(r"^\[ipv4-addr:value\s*=\s*\'(?P<address>(?:(?:25[0-5]|(?:2[0-4]|1\d|[1-9]|)\d)\.?\b){4})\'\]$")
-cs_ipv6_from_stix = re.compile(r"^\[ipv6-addr:value\s*=\s*\'(?P<address>[a-fA-F0-9:]+)\'\]$")
+cs_types = {"sha256", "md5", "domain", "ipv4", "ipv6"}
 
-stix_hash_type_to_cs = {"SHA-256": "sha256", "MD5": "md5"}
+# Largest page/batch sizes accepted by the Falcon IOC API
+cs_query_page_size = 500
+cs_write_batch_size = 200
+cs_delete_batch_size = 500
+
+def chunked(items: list, size: int) -> Iterator[list]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def parse_expiration(expiration: str | None) -> Instant | None:
+    return Instant.parse_rfc3339(expiration) if expiration is not None else None
+
+def format_expiration(expiration: Instant) -> str:
+    # Falcon expects exactly six fractional digits
+    return expiration.py_datetime().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+class CrowdStrikeMirror:
+    def __init__(self, store: StateStore, name: str):
+        self.store = store
+        self.name = name
+
+    def refreshed_at(self) -> Instant | None:
+        refreshed_at = self.store.meta(f"{self.name}_refreshed_at")
+        return Instant.parse_rfc3339(refreshed_at) if refreshed_at is not None else None
+
+    def sources(self) -> set[str]:
+        sources = self.store.meta(f"{self.name}_sources")
+        return set(json.loads(sources)) if sources is not None else set()
+
+    def add_sources(self, sources: set[str]):
+        if not sources <= self.sources():
+            self.store.set_meta(f"{self.name}_sources", json.dumps(sorted(self.sources() | sources)))
+
+    def replace(self, remote_indicators: dict[tuple[str, str], dict], refreshed_at: Instant):
+        self.store.replace(self.name, ((f"{type}|{value}", parse_expiration(existing["expiration"]), existing["id"]) for ((type, value), existing) in remote_indicators.items()))
+        self.store.set_meta(f"{self.name}_refreshed_at", refreshed_at.format_rfc3339())
+
+    def get(self, type: str, value: str) -> dict | None:
+        existing = self.store.get(self.name, f"{type}|{value}")
+        return {"id": existing[1], "expiration": existing[0]} if existing is not None else None
+
+    def set_all(self, entries: Iterable[tuple[str, str, str, str | None]]):
+        self.store.upsert(self.name, ((f"{type}|{value}", parse_expiration(expiration), id) for (type, value, id, expiration) in entries))
+
+    def remove_all(self, keys: Iterable[tuple[str, str]]):
+        self.store.remove(self.name, (f"{type}|{value}" for (type, value) in keys))
+
+    def next_expiry(self) -> Instant | None:
+        return self.store.next_expiry(self.name)
+
+    def expired(self, now: Instant) -> Iterator[tuple[str, str, str]]:
+        for (key, _, id) in self.store.expired(self.name, now):
+            (type, _, value) = key.partition("|")
+            yield (type, value, id)
 
 class CrowdStrikeIndicatorDestination(IndicatorDestination):
-    def __init__(self, log: Logger, client_id: str, client_secret: str, base_url: str, action: str, severity: str):
+    def __init__(self, log: Logger, state_dir: str, name: str, client_id: str, client_secret: str, base_url: str, action: str, severity: str, workers: int, mirror_refresh: TimeDelta):
+        super().__init__(name)
         self.action = action
         self.severity = severity
         self.falcon = IOC(client_id=client_id, client_secret=client_secret, base_url=base_url)
+        self.requests = FalconRequestScheduler(log, workers)
+        self.state_dir = state_dir
+        self.mirror_name = f"crowdstrike_{name}"
+        self.mirror_refresh = mirror_refresh
         self.log = log
 
     def consume(self, indicators: list[Indicator]):
         if len(indicators) != 0:
-            indicators = self.convert_all_dedupe(indicators)
+            with metrics.timed("convert"):
+                indicators = self.convert_all_dedupe(indicators)
             self.log.info("Finished converting IoCs to CrowdStrike format")
-            for indicator in indicators:
-                response = self.falcon.indicator_combined(from_parent=False, filter=f"type:'{indicator["type"]}'+value:'{indicator["value"]}'")
+            with StateStore(self.state_dir) as store:
+                mirror = CrowdStrikeMirror(store, self.mirror_name)
+                now = Instant.now()
+                sources = set(indicator["source"] for indicator in indicators)
+                new_sources = sources - mirror.sources()
+                refreshed_at = mirror.refreshed_at()
+                if refreshed_at is None or refreshed_at + self.mirror_refresh < now:
+                    mirror.add_sources(sources)
+                    with metrics.timed("refresh"):
+                        remote_indicators = self.fetch_remote(mirror.sources())
+                    mirror.replace(remote_indicators, now)
+                    self.log.info(f"Refreshed local mirror with {len(remote_indicators)} existing remote indicators")
+                elif len(new_sources) != 0:
+                    # The mirror holds nothing yet for these sources, so their
+                    # existing remote IoCs are fetched before anything is created
+                    with metrics.timed("refresh"):
+                        remote_indicators = self.fetch_remote(new_sources)
+                    mirror.set_all((type, value, existing["id"], existing["expiration"]) for ((type, value), existing) in remote_indicators.items())
+                    mirror.add_sources(new_sources)
+                    self.log.info(f"Added {len(remote_indicators)} existing remote indicators from new sources {", ".join(sorted(new_sources))} to local mirror")
+                creates = []
+                updates = []
+                for indicator in indicators:
+                    existing = mirror.get(indicator["type"], indicator["value"])
+                    if existing is None:
+                        creates.append(indicator)
+                    elif existing["expiration"] is None or existing["expiration"] < Instant.parse_rfc3339(indicator["expiration"]):
+                        indicator["id"] = existing["id"]
+                        updates.append(indicator)
+                self.log.info(f"Creating {len(creates)} and updating {len(updates)} remote indicators ({len(indicators) - len(creates) - len(updates)} already current)")
+                with metrics.timed("upload"):
+                    pending_creates = [self.requests.submit(self.falcon.indicator_create, body={"comment": "Automated batch upload", "indicators": chunk}) for chunk in chunked(creates, cs_write_batch_size)]
+                    pending_updates = [(chunk, self.requests.submit(self.falcon.indicator_update, body={"comment": "Automated batch upload", "indicators": chunk})) for chunk in chunked(updates, cs_write_batch_size)]
+                    for request in pending_creates:
+                        response = request.result()
+                        self.is_error_response(response)
+                        mirror.set_all((resource["type"], resource["value"], resource["id"], resource.get("expiration")) for resource in response["body"].get("resources") or [] if "id" in resource and "value" in resource)
+                    for (chunk, request) in pending_updates:
+                        if not self.is_error_response(request.result()):
+                            mirror.set_all((indicator["type"], indicator["value"], indicator["id"], indicator["expiration"]) for indicator in chunk)
+                metrics.count("iocshuttle_indicators_written_total", len(creates) + len(updates))
+
+    def flush(self):
+        self.expire()
+
+    def next_expiration(self) -> Instant | None:
+        with StateStore(self.state_dir) as store:
+            return CrowdStrikeMirror(store, self.mirror_name).next_expiry()
+
+    def expire(self):
+        # Falcon stops matching an IoC at its expiration but keeps it, so
+        # expired IoCs are deleted explicitly
+        with StateStore(self.state_dir) as store:
+            mirror = CrowdStrikeMirror(store, self.mirror_name)
+            expired = list(mirror.expired(Instant.now()))
+            if len(expired) != 0:
+                self.log.info(f"Deleting {len(expired)} expired remote indicators")
+                with metrics.timed("expire"):
+                    pending_deletes = [(chunk, self.requests.submit(self.falcon.indicator_delete, ids=[id for (_, _, id) in chunk], comment="Automated expiry")) for chunk in chunked(expired, cs_delete_batch_size)]
+                    for (chunk, request) in pending_deletes:
+                        if not self.is_error_response(request.result()):
+                            mirror.remove_all((type, value) for (type, value, _) in chunk)
+
+    def fetch_remote(self, sources: set[str]) -> dict[tuple[str, str], dict]:
+        remote_indicators = {}
+        for source in sources:
+            after = None
+            while True:
+                response = self.requests.call(self.falcon.indicator_combined, from_parent=False, filter=f"source:'{source}'", limit=cs_query_page_size, after=after)
                 if self.is_error_response(response):
-                    continue
-                existing_id = None
-                if len(response["body"]["resources"]) > 0:
-                    remote_expiration = Instant.parse_rfc3339(response["body"]["resources"][0]["expiration"])
-                    self.log.info(f"Found existing indicator with expiration {remote_expiration}")
-                    local_expiration = Instant.parse_rfc3339(indicator["expiration"])
-                    if remote_expiration >= local_expiration:
-                        self.log.info("Remote indicator has a later expiration than local - skipping")
-                        continue
-                    existing_id = response["body"]["resources"][0]["id"]
-                if existing_id is None:
-                    self.log.info("Creating new remote indicator")
-                    response = self.falcon.indicator_create(body={"comment": "Automated batch upload", "indicators": indicator})
-                    self.is_error_response(response)
-                else:
-                    self.log.info("Updating remote indicator")
-                    indicator["id"] = existing_id
-                    response = self.falcon.indicator_update(body={"comment": "Automated batch upload", "indicators": indicator})
-                    self.is_error_response(response)
-                self.is_error_response(response)
+                    raise Exception(f"Could not retrieve existing indicators for source \"{source}\"")
+                resources = response["body"]["resources"] or []
+                for resource in resources:
+                    remote_indicators[(resource["type"], resource["value"])] = {"id": resource["id"], "expiration": resource.get("expiration")}
+                after = response["body"].get("meta", {}).get("pagination", {}).get("after")
+                if not after or len(resources) == 0:
+                    break
+        return remote_indicators
     
     def is_error_response(self, response: dict) -> bool:
         if not HTTPStatus(response["status_code"]).is_success:
@@ -64,13 +177,14 @@ class CrowdStrikeIndicatorDestination(IndicatorDestination):
     def convert_all_dedupe(self, source_indicators: list[Indicator]) -> list[dict]:
         indicators = []
         seen_indicators = set()
-        for indicator in sorted(source_indicators, key=lambda indicator: indicator.valid_from, reverse=True): # descending order
+        for indicator in sorted(source_indicators, key=lambda indicator: indicator.valid_from_nanos, reverse=True): # descending order
             try:
                 converted = self.convert(indicator)
                 if not (converted["type"], converted["value"]) in seen_indicators:
                     seen_indicators.add((converted["type"], converted["value"]))
                     indicators.append(converted)
             except STIXConversionException as warn:
+                metrics.count("iocshuttle_conversion_failures_total")
                 self.log.warning(warn)
         self.log.info(f"Removed {len(source_indicators) - len(indicators)} duplicate indicators from {len(source_indicators)} source indicators")
         return indicators
@@ -85,31 +199,13 @@ class CrowdStrikeIndicatorDestination(IndicatorDestination):
             "severity": self.severity,
             "retrodetects": True,
             "description": indicator.name,
-            "expiration": indicator.valid_to.format_rfc3339().replace(" ", "T").replace("Z", "000Z"),
+            "expiration": format_expiration(indicator.valid_to),
             "platforms": ["mac", "windows", "linux"],
             "tags": [f"tlp:{indicator.tlp}"],
             "source": indicator.source
         }
-        for expression_fragment in cs_hash_from_stix.finditer(indicator.pattern):
-            if expression_fragment is not None:
-                hash = expression_fragment.groupdict()
-                if hash["type"] in stix_hash_type_to_cs:
-                    ioc["type"] = stix_hash_type_to_cs[hash["type"]]
-                    ioc["value"] = hash["value"].lower()
-                    return ioc
-        for expression_fragment in cs_fqdn_from_stix.finditer(indicator.pattern):
-            if expression_fragment is not None:
-                ioc["type"] = "domain"
-                ioc["value"] = expression_fragment.groupdict()["fqdn"].lower()
-                return ioc
-        for expression_fragment in cs_ipv4_from_stix.finditer(indicator.pattern):
-            if expression_fragment is not None:
-                ioc["type"] = "ipv4"
-                ioc["value"] = expression_fragment.groupdict()["address"].lower()
-                return ioc
-        for expression_fragment in cs_ipv6_from_stix.finditer(indicator.pattern):
-            if expression_fragment is not None:
-                ioc["type"] = "ipv6"
-                ioc["value"] = expression_fragment.groupdict()["address"].lower()
-                return ioc
+        converted = classify(indicator.pattern)
+        if converted is not None and converted[0] in cs_types:
+            (ioc["type"], ioc["value"]) = converted
+            return ioc
         raise STIXConversionException(f"Pattern \"{indicator.pattern}\" cannot be coerced into a CrowdStrike IoC")
\ No newline at end of file
@@ -1,108 +1,155 @@
-from common import Indicator, STIXConversionException, IndicatorDestination
+from common import Indicator, STIXConversionException, IndicatorDestination, StateStore, classify, metrics
 from whenever import Instant
 from logging import Logger
-from netaddr import IPAddress, IPSet
+from netaddr import IPAddress, iprange_to_cidrs
 from typing import Callable
-from collections.abc import Iterator
-import shelve
-import re
+from collections.abc import Iterable, Iterator
 import tempfile
-import shutil
+import hashlib
+import gzip
+import stat
 import os
 
-edl_fqdn_from_stix = re.compile(r"^\[domain-name:value\s*=\s*'(?P<fqdn>(?:(?:(?!-))(?:xn--|_)?[a-z0-9-]{0,61}[a-z0-9]{1,1}\.)*(?:xn--)?(?:[a-z0-9][a-z0-9\-]{0,60}|[a-z0-9-]{1,30}\.[a-z]{2,}))'\]$")
-edl_ip_from_stix = re.compile(r"^\[ipv4-addr:value\s*=\s*\'(?P<address>(?:(?:25[0-5]|(?:2[0-4]|1\d|[1-9]|)\d)\.?\b){4}|[a-fA-F0-9:]+)\'\]$")
-edl_url_from_stix = re.compile(r"^\[url:value\s*=\s*\'(?P<url>.+)\'\]$")
+edl_types = {"domain": "domain", "ipv4": "ip", "ipv6": "ip", "url": "url"}
 
 class EDLShelf:
-    def __init__(self, name: str):
+    def __init__(self, store: StateStore, name: str):
+        self.store = store
         self.name = name
-    
-    def __enter__(self):
-        self.shelf = shelve.open(self.name, "c")
-        return self
-    
-    def __exit__(self, exception_type, exception_value, exception_traceback):
-        self.shelf.close()
+        store.migrate_shelf(os.path.join(store.state_dir, name), lambda shelf: self.add_all(shelf.items()))
 
-    def add_if_newer(self, item: str, valid_to: Instant):
-        if item not in self.shelf or self.shelf[item] < valid_to:
-            self.shelf[item] = valid_to
+    def add_all(self, items: Iterable[tuple[str, Instant]]):
+        self.store.upsert(self.name, ((item, valid_to, None) for (item, valid_to) in items))
     
     def expire(self, now: Instant):
-        for (key, valid_to) in self.shelf.items():
-            if valid_to < now:
-                del self.shelf[key]
+        self.store.expire(self.name, now)
+
+    def members(self) -> Iterator[str]:
+        return self.store.keys(self.name)
+
+    def next_expiry(self) -> Instant | None:
+        return self.store.next_expiry(self.name)
     
-    def export(self, to: str, compact: Callable[[Iterator[str]], Iterator[str]]):
-        with tempfile.NamedTemporaryFile(mode="w", newline="\n", encoding="utf8", delete=True, delete_on_close=False) as tmp:
-            for line in compact(self.shelf.keys()):
-                tmp.write(line)
-                tmp.write("\n")
-            tmp.close()
-            shutil.copyfile(tmp.name, to)
-
-def compact_ips(source: Iterator[str]) -> Iterator[str]:
-    ips = IPSet([IPAddress(x) for x in source])
-    ips.compact()
-    return (x.__str__() for x in ips)
+    def export(self, to: str, compact: Callable[[Iterator[str]], Iterator[str]], compress: bool, etag: bool) -> bool:
+        # Only rewrites the list when its membership changed since the last
+        # export to this path, or when one of the published files is missing
+        version = str(self.store.version(self.name))
+        outputs = [to] + ([to + ".gz"] if compress else []) + ([to + ".etag"] if etag else [])
+        if self.store.meta(f"exported_{to}") == version and all(os.path.exists(output) for output in outputs):
+            return False
+        content = "".join(f"{line}\n" for line in compact(self.members())).encode("utf8")
+        publish(to, content)
+        if compress:
+            publish(to + ".gz", gzip.compress(content, mtime=0))
+        if etag:
+            publish(to + ".etag", f"\"{hashlib.sha256(content).hexdigest()}\"\n".encode("utf8"))
+        self.store.set_meta(f"exported_{to}", version)
+        return True
+
+def publish(to: str, content: bytes):
+    # Written beside the target and renamed over it, so pollers only ever see
+    # a complete file
+    mode = stat.S_IMODE(os.stat(to).st_mode) if os.path.exists(to) else 0o644
+    with tempfile.NamedTemporaryFile(mode="wb", dir=os.path.dirname(os.path.abspath(to)), prefix=f".{os.path.basename(to)}.", delete=False) as tmp:
+        try:
+            tmp.write(content)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+            os.chmod(tmp.name, mode)
+        except BaseException:
+            os.unlink(tmp.name)
+            raise
+    os.replace(tmp.name, to)
+    metrics.count("iocshuttle_bytes_written_total", len(content), file=os.path.basename(to))
+
+class EDLIPShelf(EDLShelf):
+    # Addresses are kept as merged ranges per address family, updated in place
+    # as addresses are added and expire, so export only has to walk them.  A
+    # legacy edl_ips shelf is migrated through add_all, straight into the ranges
+    def add_all(self, items: Iterable[tuple[str, Instant]]):
+        self.store.add_addresses(self.name, ((address.version, int(address), valid_to) for (address, valid_to) in ((IPAddress(item), valid_to) for (item, valid_to) in items)))
+
+    def expire(self, now: Instant):
+        self.store.expire_addresses(self.name, now)
+
+    def next_expiry(self) -> Instant | None:
+        return self.store.next_address_expiry(self.name)
+
+    def members(self) -> Iterator[str]:
+        for (family, first, last) in self.store.address_ranges(self.name):
+            for cidr in iprange_to_cidrs(IPAddress(first, family), IPAddress(last, family)):
+                yield str(cidr.ip) if cidr.size == 1 else str(cidr)
 
 def strip_proto(source: Iterator[str]) -> Iterator[str]:
     return (x.partition("//")[2] for x in source)
 
 class EDLDestination(IndicatorDestination):
-    def __init__(self, log: Logger, state_dir: str, output_dir: str, domain_filename: str, ip_filename: str, url_filename: str):
+    def __init__(self, log: Logger, state_dir: str, name: str, output_dir: str, domain_filename: str, ip_filename: str, url_filename: str, compress: bool, etag: bool):
+        super().__init__(name)
         self.log = log
         self.state_dir = state_dir
         self.output_dir = output_dir
         self.domain_filename = domain_filename
         self.ip_filename = ip_filename
         self.url_filename = url_filename
+        self.compress = compress
+        self.etag = etag
 
     def consume(self, indicators: list[Indicator]):
-        with EDLShelf(os.path.join(self.state_dir, "edl_domains")) as domains, EDLShelf(os.path.join(self.state_dir, "edl_ips")) as ips, EDLShelf(os.path.join(self.state_dir, "edl_urls")) as urls:
-            for indicator in indicators:
-                try:
-                    edl_entry = self.convert(indicator)
-                except STIXConversionException as err:
-                    self.log.warn(err)
-                    continue
-                match (edl_entry["type"]):
-                    case "domain":
-                        domains.add_if_newer(edl_entry["value"], indicator.valid_to)
-                    case "ip":
-                        ips.add_if_newer(edl_entry["value"], indicator.valid_to)
-                    case "url":
-                        urls.add_if_newer(edl_entry["value"], indicator.valid_to)
+        with StateStore(self.state_dir) as store:
+            domains = EDLShelf(store, "edl_domains")
+            ips = EDLIPShelf(store, "edl_ips")
+            urls = EDLShelf(store, "edl_urls")
+            entries = {"domain": {}, "ip": {}, "url": {}}
+            with metrics.timed("convert"):
+                for indicator in indicators:
+                    try:
+                        edl_entry = self.convert(indicator)
+                    except STIXConversionException as err:
+                        metrics.count("iocshuttle_conversion_failures_total")
+                        self.log.warn(err)
+                        continue
+                    pending = entries[edl_entry["type"]]
+                    if edl_entry["value"] not in pending or pending[edl_entry["value"]] < indicator.valid_to:
+                        pending[edl_entry["value"]] = indicator.valid_to
+            with metrics.timed("store"):
+                domains.add_all(entries["domain"].items())
+                ips.add_all(entries["ip"].items())
+                urls.add_all(entries["url"].items())
+
+    def flush(self):
+        self.expire()
+
+    def next_expiration(self) -> Instant | None:
+        with StateStore(self.state_dir) as store:
+            expiries = [shelf.next_expiry() for shelf in [EDLShelf(store, "edl_domains"), EDLIPShelf(store, "edl_ips"), EDLShelf(store, "edl_urls")]]
+        return min((expiry for expiry in expiries if expiry is not None), default=None)
+
+    def expire(self):
+        # Also exports any list whose membership changed since it was last
+        # exported, so this publishes what consume added as well
+        with StateStore(self.state_dir) as store:
+            domains = EDLShelf(store, "edl_domains")
+            ips = EDLIPShelf(store, "edl_ips")
+            urls = EDLShelf(store, "edl_urls")
             now = Instant.now()
-            domains.expire(now)
-            ips.expire(now)
-            urls.expire(now)
+            with metrics.timed("expire"):
+                domains.expire(now)
+                ips.expire(now)
+                urls.expire(now)
 
-            domains.export(os.path.join(self.output_dir, self.domain_filename), lambda x: x)
-            ips.export(os.path.join(self.output_dir, self.ip_filename), compact_ips)
-            urls.export(os.path.join(self.output_dir, self.url_filename), strip_proto)
+            for (shelf, filename, compact) in [(domains, self.domain_filename, lambda x: x), (ips, self.ip_filename, lambda x: x), (urls, self.url_filename, strip_proto)]:
+                with metrics.timed("export", file=filename):
+                    exported = shelf.export(os.path.join(self.output_dir, filename), compact, self.compress, self.etag)
+                if exported:
+                    self.log.info(f"Exported {filename}")
+                else:
+                    self.log.info(f"{filename} is unchanged - skipped export")
 
     def convert(self, indicator: Indicator) -> dict:
         if indicator.pattern_type != "stix":
             raise STIXConversionException(f"Pattern type {indicator.pattern_type} isn't convertible")
-        ioc = {}
-        try:
-            for expression_fragment in edl_fqdn_from_stix.finditer(indicator.pattern):
-                if expression_fragment is not None:
-                    ioc["type"] = "domain"
-                    ioc["value"] = expression_fragment.groupdict()["fqdn"].lower()
-                    return ioc
-            for expression_fragment in edl_ip_from_stix.finditer(indicator.pattern):
-                if expression_fragment is not None:
-                    ioc["type"] = "ip"
-                    ioc["value"] = IPAddress(expression_fragment.groupdict()["address"].lower()).__str__()
-                    return ioc
-            for expression_fragment in edl_url_from_stix.finditer(indicator.pattern):
-                if expression_fragment is not None:
-                    ioc["type"] = "url"
-                    ioc["value"] = expression_fragment.groupdict()["url"].lower()
-                    return ioc
-        except Exception as err:
-            raise STIXConversionException(err)
+        converted = classify(indicator.pattern)
+        if converted is not None and converted[0] in edl_types:
+            return {"type": edl_types[converted[0]], "value": converted[1]}
         raise STIXConversionException(f"Pattern \"{indicator.pattern}\" cannot be coerced into a EDL list member")
\ No newline at end of file
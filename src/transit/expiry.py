@@ -0,0 +1,77 @@
+from common import IndicatorDestination, metrics
+from whenever import Instant, TimeDelta
+from logging import Logger
+import itertools
+import threading
+import heapq
+
+class ExpiryScheduler:
+    # Keeps the next expiration of every destination in a heap and sleeps
+    # until the earliest is due, rather than checking on every polling tick.
+    # A destination is swept at most once per granularity, so entries expiring
+    # close together are removed in one bulk sweep
+    def __init__(self, log: Logger, granularity: TimeDelta):
+        self.log = log
+        self.granularity_nanos = granularity.in_nanoseconds()
+        self.heap: list[tuple[int, int, IndicatorDestination]] = []
+        self.due: dict[str, int] = {}
+        self.swept: dict[str, int] = {}
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name="expiry", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def schedule(self, destination: IndicatorDestination):
+        # Called whenever a destination's contents may have changed.  Entries
+        # superseded by a later call are discarded when they reach the top
+        with destination.lock:
+            expiration = destination.next_expiration()
+        with self.condition:
+            if expiration is None:
+                self.due.pop(destination.name, None)
+                return
+            due = max(expiration.timestamp_nanos(), self.swept.get(destination.name, 0) + self.granularity_nanos)
+            if self.due.get(destination.name) == due:
+                return
+            self.due[destination.name] = due
+            heapq.heappush(self.heap, (due, next(self.sequence), destination))
+            self.condition.notify()
+
+    def next_due(self) -> IndicatorDestination | None:
+        with self.condition:
+            while not self.stopped:
+                while len(self.heap) != 0 and self.due.get(self.heap[0][2].name) != self.heap[0][0]:
+                    heapq.heappop(self.heap)
+                if len(self.heap) == 0:
+                    self.condition.wait()
+                    continue
+                wait = (self.heap[0][0] - Instant.now().timestamp_nanos()) / 1_000_000_000
+                if wait > 0:
+                    self.condition.wait(wait)
+                    continue
+                (_, _, destination) = heapq.heappop(self.heap)
+                del self.due[destination.name]
+                self.swept[destination.name] = Instant.now().timestamp_nanos()
+                return destination
+            return None
+
+    def run(self):
+        # A destination whose sweep fails is scheduled again at the end of its
+        # next cycle
+        while (destination := self.next_due()) is not None:
+            try:
+                with destination.lock, metrics.context(destination=destination.name):
+                    self.log.info(f"Removing expired indicators from {destination.name}")
+                    destination.expire()
+                    metrics.count("iocshuttle_expiry_sweeps_total")
+                self.schedule(destination)
+            except Exception as err:
+                self.log.exception(err)
@@ -0,0 +1,87 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections.abc import Callable
+from common import metrics
+from logging import Logger
+import contextvars
+import random
+import threading
+import time
+
+retryable_statuses = {429, 500, 502, 503, 504}
+
+def header(response: dict, name: str) -> str | None:
+    for key, value in (response.get("headers") or {}).items():
+        if key.lower() == name:
+            return value
+    return None
+
+class FalconRateLimiter:
+    # Token bucket seeded from the X-RateLimit-* headers Falcon returns on every response
+    def __init__(self, requests_per_minute: int):
+        self.capacity = float(requests_per_minute)
+        self.tokens = self.capacity
+        self.refilled_at = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.refilled_at) * self.capacity / 60)
+        self.refilled_at = now
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.refill(now)
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.blocked_until - now, (1 - self.tokens) * 60 / self.capacity)
+            time.sleep(wait)
+
+    def observe(self, response: dict):
+        limit = header(response, "x-ratelimit-limit")
+        remaining = header(response, "x-ratelimit-remaining")
+        retry_after = header(response, "x-ratelimit-retryafter")
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            if limit is not None and limit.isdigit() and int(limit) > 0:
+                self.capacity = float(limit)
+            if remaining is not None and remaining.isdigit():
+                self.tokens = min(self.tokens, float(remaining))
+            if retry_after is not None and retry_after.isdigit():
+                # RetryAfter is an epoch timestamp in seconds
+                self.blocked_until = max(self.blocked_until, now + max(0, int(retry_after) - time.time()))
+
+class FalconRequestScheduler:
+    def __init__(self, log: Logger, workers: int, requests_per_minute: int = 6000, max_retries: int = 5, backoff_seconds: float = 1.0, max_backoff_seconds: float = 60.0):
+        self.log = log
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="falcon")
+        self.limiter = FalconRateLimiter(requests_per_minute)
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+
+    def call(self, operation: Callable[..., dict], **kwargs) -> dict:
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            try:
+                response = operation(**kwargs)
+            except Exception as err:
+                response = {"status_code": 500, "headers": {}, "body": {"errors": [{"message": str(err)}]}}
+            self.limiter.observe(response)
+            metrics.count("iocshuttle_api_calls_total", operation=operation.__name__, status=str(response["status_code"]))
+            if response["status_code"] not in retryable_statuses or attempt >= self.max_retries:
+                return response
+            attempt += 1
+            metrics.count("iocshuttle_api_retries_total", operation=operation.__name__)
+            delay = random.uniform(0, min(self.max_backoff_seconds, self.backoff_seconds * 2 ** attempt)) # full jitter
+            self.log.warning(f"{operation.__name__} returned {response["status_code"]} - retrying in {delay:.1f}s (attempt {attempt} of {self.max_retries})")
+            time.sleep(delay)
+
+    def submit(self, operation: Callable[..., dict], **kwargs) -> Future[dict]:
+        # Run in a copy of the caller's context so the request is counted
+        # against the caller's connection and destination
+        return self.executor.submit(contextvars.copy_context().run, self.call, operation, **kwargs)
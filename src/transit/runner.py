@@ -0,0 +1,83 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections.abc import Callable
+from common import metrics
+from whenever import Instant, TimeDelta
+from logging import Logger
+import threading
+import cProfile
+import time
+import os
+
+class ConnectionRunner:
+    # Runs each connection on its own worker so a slow source or destination
+    # only delays itself, and skips a connection whose previous run is still
+    # going rather than queueing another behind it
+    def __init__(self, workers: int, frequency: TimeDelta, metrics_path: str | None = None, profile_dir: str | None = None):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="connection")
+        self.running: dict[str, Future] = {}
+        self.lock = threading.Lock()
+        self.frequency = frequency
+        self.metrics_path = metrics_path
+        self.profile_dir = profile_dir
+        # Only one profiler can be active at a time, so while one connection
+        # is being profiled the others run unprofiled
+        self.profile_lock = threading.Lock()
+
+    def submit(self, log: Logger, connection_name: str, job: Callable, **kwargs) -> Future | None:
+        with self.lock:
+            previous = self.running.get(connection_name)
+            if previous is not None and not previous.done():
+                log.warning(f"Previous run of {connection_name} is still in progress - skipping this cycle")
+                metrics.count("iocshuttle_cycles_skipped_total", connection=connection_name)
+                return None
+            self.running[connection_name] = self.executor.submit(self.run, log, connection_name, job, **kwargs)
+            return self.running[connection_name]
+
+    def run(self, log: Logger, connection_name: str, job: Callable, **kwargs) -> bool:
+        # Returns whether the job succeeded
+        with metrics.context(connection=connection_name):
+            started = time.perf_counter()
+            outcome = "success"
+            try:
+                self.profiled(log, connection_name, job, **kwargs)
+            except Exception as err:
+                outcome = "failure"
+                log.exception(err)
+            duration = time.perf_counter() - started
+            metrics.count("iocshuttle_cycles_total", outcome=outcome)
+            metrics.gauge("iocshuttle_cycle_seconds", duration)
+            metrics.gauge("iocshuttle_cycle_completed_timestamp_seconds", time.time())
+            if duration > self.frequency.in_seconds():
+                metrics.count("iocshuttle_cycle_overruns_total")
+                log.warning(f"Cycle took {duration:.0f}s, longer than the {self.frequency.in_minutes():g} minute frequency - the next cycle will be skipped")
+        if self.metrics_path is not None:
+            try:
+                metrics.write(self.metrics_path)
+            except OSError as err:
+                log.error(f"Could not write metrics to {self.metrics_path}: {err}")
+        return outcome == "success"
+
+    def profiled(self, log: Logger, connection_name: str, job: Callable, **kwargs):
+        if self.profile_dir is None or not self.profile_lock.acquire(blocking=False):
+            job(log=log, **kwargs)
+            return
+        try:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError as err:
+                log.warning(f"Could not profile this cycle: {err}")
+                job(log=log, **kwargs)
+                return
+            try:
+                job(log=log, **kwargs)
+            finally:
+                profiler.disable()
+                profile_path = os.path.join(self.profile_dir, f"{connection_name}-{Instant.now().timestamp()}.prof")
+                profiler.dump_stats(profile_path)
+                log.info(f"Wrote cycle profile to {profile_path}")
+        finally:
+            self.profile_lock.release()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -1,42 +1,104 @@
-from common import Indicator, IndicatorSource, IndicatorBatch
-from taxii2client.v21 import Server, as_pages
+from common import Indicator, IndicatorSource, IndicatorBatch, metrics
+from taxii2client.v21 import Server, Collection, as_pages
 from whenever import Instant, TimeDelta
 from collections.abc import Iterator
 from logging import Logger
+import contextvars
 import logging
+import threading
+import time
 import typing
+import queue
 
 taxii2logger = logging.getLogger("taxii2client")
 taxii2logger.propagate = True
-while taxii2logger.hasHandlers():
-    taxii2logger.removeHandler(taxii2logger.handlers[0])
+for handler in list(taxii2logger.handlers):
+    taxii2logger.removeHandler(handler)
 
 tlp_to_level = {"white":0, "green":1, "amber":2, "red":3}
 level_to_tlp = {0:"white", 1:"green", 2:"amber", 3:"red"}
 
+class PagePrefetcher:
+    # Downloads pages on a background thread, up to depth pages ahead of the
+    # consumer, so the next page is in flight while the current one is parsed
+    def __init__(self, pages: Iterator[dict], depth: int):
+        self.pages = pages
+        self.queue = queue.Queue(maxsize=max(1, depth))
+        self.stopped = threading.Event()
+        # The thread runs in a copy of the consumer's context so its timings are
+        # recorded against the consumer's connection
+        self.thread = threading.Thread(target=contextvars.copy_context().run, args=(self.fetch,), name="taxii-prefetch", daemon=True)
+        self.thread.start()
+
+    def fetch(self):
+        try:
+            started = time.perf_counter()
+            for page in self.pages:
+                metrics.observe("fetch", time.perf_counter() - started)
+                if not self.put(("page", page)):
+                    return
+                started = time.perf_counter()
+            self.put(("done", None))
+        except Exception as err:
+            self.put(("error", err))
+
+    def put(self, item: tuple) -> bool:
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self) -> Iterator[dict]:
+        try:
+            while True:
+                (kind, item) = self.queue.get()
+                if kind == "done":
+                    return
+                if kind == "error":
+                    raise item
+                yield item
+        finally:
+            self.stopped.set()
+
 class TAXII21IndicatorSource(IndicatorSource):
-    def __init__(self, log: Logger, url: str, user: str, password: str):
+    def __init__(self, log: Logger, url: str, user: str, password: str, page_size: int, prefetch: int):
         self.server = Server(url, user=user, password=password)
+        self.page_size = page_size
+        self.prefetch = prefetch
+        self.collections: dict[str, Collection] = {}
+        self.discovery_lock = threading.Lock()
         self.log = log
+
+    def collection(self, collection_name: str) -> Collection:
+        # Discovery and collection metadata are fetched once and reused, and
+        # only looked up again if a collection we haven't seen is requested
+        with self.discovery_lock:
+            if collection_name not in self.collections:
+                if len(self.collections) != 0:
+                    self.server.refresh()
+                self.collections = dict((collection.title, collection) for collection in self.server.api_roots[0].collections)
+            if collection_name not in self.collections:
+                raise Exception(f"Could not locate collection with title \"{collection_name}\"")
+            return self.collections[collection_name]
     
     def produce(self, collection_name: str, since: typing.Optional[Instant], valid_for: TimeDelta) -> Iterator[IndicatorBatch]:
         if since is None:
             since = Instant.now() - valid_for
-        api_root = self.server.api_roots[0]
-        collections = [collection for collection in api_root.collections if collection.title == collection_name]
-        collection = collections[0] if collections else None
-        if collection is None:
-            raise Exception(f"Could not locate collection with title \"{collection_name}\"")
-        for envelope in as_pages(collection.get_objects, per_request=200, type="indicator,marking-definition,identity", added_after=since.format_rfc3339().replace(" ", "T")):
+        collection = self.collection(collection_name)
+        for envelope in PagePrefetcher(as_pages(collection.get_objects, per_request=self.page_size, type="indicator,marking-definition,identity", added_after=since.format_rfc3339().replace(" ", "T")), self.prefetch):
             indicators = []
             if "objects" in envelope:
-                marking_definitions = dict([(obj["id"], obj) for obj in envelope["objects"] if obj["type"] == "marking-definition"])
-                identities = dict([(obj["id"], obj["name"]) for obj in envelope["objects"] if obj["type"] == "identity"])
-                for obj in [obj for obj in envelope["objects"] if obj["type"] == "indicator"]:
-                    object_markings = [marking_definitions[marking_definition] for marking_definition in obj["object_marking_refs"]]
-                    tlp_markings = [object_marking["definition"]["tlp"].lower() for object_marking in object_markings if object_marking["definition_type"].lower() == "tlp"]
-                    highest_tlp = level_to_tlp[max(tlp_to_level[tlp_marking] for tlp_marking in tlp_markings)]
-                    indicators.append(Indicator(obj, highest_tlp, valid_for, identities[obj["created_by_ref"]]))
+                with metrics.timed("parse"):
+                    marking_definitions = dict([(obj["id"], obj) for obj in envelope["objects"] if obj["type"] == "marking-definition"])
+                    identities = dict([(obj["id"], obj["name"]) for obj in envelope["objects"] if obj["type"] == "identity"])
+                    for obj in [obj for obj in envelope["objects"] if obj["type"] == "indicator"]:
+                        object_markings = [marking_definitions[marking_definition] for marking_definition in obj["object_marking_refs"]]
+                        tlp_markings = [object_marking["definition"]["tlp"].lower() for object_marking in object_markings if object_marking["definition_type"].lower() == "tlp"]
+                        highest_tlp = level_to_tlp[max(tlp_to_level[tlp_marking] for tlp_marking in tlp_markings)]
+                        indicators.append(Indicator(obj, highest_tlp, valid_for, identities[obj["created_by_ref"]]))
             last_added = None
             if "x_cyber_gc_ca_date_added_last" in envelope:
                 self.log.info(f"Received {len(indicators)} indicators dated {envelope["x_cyber_gc_ca_date_added_last"]}")